@@ -22,7 +22,7 @@
 
 from lxml import objectify
 from .unsfs import SFS_reader
-import codecs
+import base64
 from datetime import datetime
 import numpy as np
 
@@ -134,9 +134,10 @@ class HyperHeader(object):
         self.image.images = []
         for i in range(self.image.plane_count):
             img = imageData.xpath("Plane" + str(i))[0]
-            raw = codecs.decode((img.Data.text).encode('ascii'), 'base64')
-            array1 = np.fromstring(raw, dtype=np.uint16)
-            if any(array1):
+            # decoded into bytearray, so the image data is writable:
+            raw = bytearray(base64.b64decode(img.Data.text))
+            array1 = np.frombuffer(raw, dtype='<u2')
+            if array1.any():
                 temp_img = Container()
                 temp_img.data = array1.reshape((self.image.height,
                                                 self.image.width))
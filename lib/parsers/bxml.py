@@ -21,6 +21,7 @@
 # At the moment EDS, SEM images and mapping results based on static images
 # are supported.
 
+import base64
 import numpy as np
 from scipy.interpolate import UnivariateSpline
 
@@ -133,7 +134,7 @@ class BasicEDXSpectrum(object):
         
          # decode silly hidden detector layer info:
         det_l_str = self.detector_metadata['DetLayers']
-        dec_det_l_str = codecs.decode(det_l_str.encode('ascii'), 'base64')
+        dec_det_l_str = base64.b64decode(det_l_str)
         mini_xml = objectify.fromstring(unzip_block(dec_det_l_str))
         self.detector_metadata['DetLayers'] = {}  # Overwrite with dict
         for i in mini_xml.getchildren():
@@ -0,0 +1,719 @@
+"""Checks of lib/parsers/bcf_hype.py: the hypermap parsers against
+synthetic SpectrumData streams, the SFS reader against synthetic
+containers, and the xml header helpers.
+
+Run from the repository root with:
+    python -m unittest discover tests
+"""
+import base64
+import os
+import pickle
+import random
+import struct
+import tempfile
+import unittest
+import xml.etree.ElementTree as ET
+import zlib
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+
+from lib.parsers import bcf_hype
+
+
+def _pack_12bit(pulses):
+    """pack channel indexes to 12-bit packed pulses (4 in 6 bytes)"""
+    p = list(pulses) + [0] * (-len(pulses) % 4)
+    out = bytearray()
+    for g in range(0, len(p), 4):
+        c0, c1, c2, c3 = p[g:g + 4]
+        out += struct.pack('<HHH', (c0 << 4) | (c1 >> 8),
+                           ((c1 & 0xFF) << 8) | (c2 >> 4),
+                           ((c2 & 0xF) << 12) | c3)
+    return bytes(out)
+
+
+def _pack_instructed(spec, rnd):
+    """pack list of channel counts to the instructions of
+    (size_p, channels, gain, values)"""
+    out = bytearray()
+    i = 0
+    while i < len(spec):
+        run = spec[i:i + rnd.randint(1, 40)]
+        gain = min(run)
+        rel = [v - gain for v in run]
+        if not any(run):
+            size_p = 0
+        elif max(rel) < 16 and gain < 256:
+            size_p = rnd.choice([1, 2, 4, 8])
+        elif max(rel) < 256 and gain < 0x10000:
+            size_p = rnd.choice([2, 4, 8])
+        else:
+            size_p = rnd.choice([4, 8])
+        out += struct.pack('<BB', size_p, len(run))
+        if size_p == 1:
+            rel += [0] * (len(run) % 2)
+            out += struct.pack('<B', gain)
+            out += bytes(rel[k] | (rel[k + 1] << 4)
+                         for k in range(0, len(rel), 2))
+        elif size_p:
+            gain_fmt, val_fmt = {2: ('H', 'B'), 4: ('I', 'H'),
+                                 8: ('Q', 'I')}[size_p]
+            out += struct.pack('<' + gain_fmt, gain)
+            out += struct.pack('<{0}{1}'.format(len(rel), val_fmt), *rel)
+        i += len(run)
+    return bytes(out)
+
+
+def build_spectrum_data(height, width, chan, seed=0, flags=(0, 1, 2),
+                        max_count=3000, short=False):
+    """build SpectrumData stream of height * width map with randomly
+    packed pixels using any of the flags (>1 - instructed).
+    If short, pixels have random chan1 < chan, the pulses and channels
+    at and above it are in the stream, but not in the truth.
+
+    Returns:
+    (bytes, truth) -- the stream and the (y, x, E) int64 hypermap in it.
+    """
+    rnd = random.Random(seed)
+    truth = np.zeros((height, width, chan), dtype=np.int64)
+    data = bytearray(struct.pack('<ii', height, width))
+    data += bytes(0x1A0 - len(data))
+    pix_head = struct.Struct('<IHHIHHHI')
+    for y in range(height):
+        xs = sorted(rnd.sample(range(width), rnd.randint(0, width)))
+        data += struct.pack('<i', len(xs))
+        for x in xs:
+            flag = rnd.choice(flags)
+            chan1 = rnd.randint(1, chan) if short else chan
+            pixel = np.zeros(chan, dtype=np.int64)
+            if flag < 2:
+                pulses = [rnd.randrange(chan)
+                          for _ in range(rnd.randint(0, 60))]
+                np.add.at(pixel, pulses, 1)
+                if flag == 0:
+                    payload = struct.pack('<{0}H'.format(len(pulses)),
+                                          *pulses)
+                else:
+                    payload = _pack_12bit(pulses)
+                data += pix_head.pack(x, chan1, chan1, 0, flag, len(payload),
+                                      len(pulses), len(payload))
+                data += payload
+            else:
+                chan2 = rnd.randint(1, chan)
+                spec = [0] * chan2
+                for _ in range(rnd.randint(0, 30)):
+                    spec[rnd.randrange(chan2)] += rnd.randint(1, max_count)
+                payload = _pack_instructed(spec, rnd)
+                add = [rnd.randrange(chan2)
+                       for _ in range(rnd.choice([0, rnd.randint(1, 20)]))]
+                pixel[:chan2] += spec
+                np.add.at(pixel, add, 1)
+                data += pix_head.pack(x, chan1, chan2, 0, flag, len(payload),
+                                      len(add), len(payload) + 4)
+                data += payload + struct.pack('<I', 2 * len(add))
+                data += struct.pack('<{0}H'.format(len(add)), *add)
+            truth[y, x, :chan1] = pixel[:chan1]
+    return bytes(data), truth
+
+
+def make_reader(data, chan, depth, chunk=1024):
+    """BCF_reader serving data as its SpectrumData in chunks of chunk
+    bytes, with header estimates replaced by chan and depth."""
+    reader = bcf_hype.BCF_reader.__new__(bcf_hype.BCF_reader)
+    reader.def_index = 0
+    reader.fast_unbcf = False
+    height, width = struct.unpack_from('<ii', data)
+    reader.header = SimpleNamespace(
+        image=SimpleNamespace(height=height, width=width),
+        estimate_map_channels=lambda index=0: chan,
+        estimate_map_depth=lambda index=0, downsample=1: depth)
+
+    def get_iter_and_properties(views=False, first=0):
+        blocks = [data[i:i + chunk] for i in range(0, len(data), chunk)]
+        return iter(blocks[first:]), chunk, len(blocks) - first
+
+    spectrum_file = SimpleNamespace(
+        get_iter_and_properties=get_iter_and_properties)
+    reader.get_file = lambda path: spectrum_file
+    return reader
+
+
+def expected(truth, depth, downsample=1, cutoff=None):
+    """sum the truth the way parsers downsample it (wrapping to depth)"""
+    height, width, chan = truth.shape
+    out = np.zeros((-(-height // downsample), -(-width // downsample), chan),
+                   dtype=np.int64)
+    for y in range(height):
+        for x in range(width):
+            out[y // downsample, x // downsample] += truth[y, x]
+    return out[:, :, :cutoff].astype(depth)
+
+
+class TestPyParseHypermap(unittest.TestCase):
+
+    chan = 300
+    depth = np.uint16
+
+    def setUp(self):
+        self.data, self.truth = build_spectrum_data(11, 9, self.chan)
+        self.jit = bcf_hype.jit_unbcf
+
+    def tearDown(self):
+        bcf_hype.jit_unbcf = self.jit
+
+    def reader(self, jit, chunk=1024):
+        bcf_hype.jit_unbcf = jit
+        return make_reader(self.data, self.chan, self.depth, chunk=chunk)
+
+    def parse(self, jit, chunk=1024, **kwargs):
+        return self.reader(jit, chunk).py_parse_hypermap(index=0, **kwargs)
+
+    def backends(self):
+        return [False, True] if self.jit else [False]
+
+    def check_backend(self, jit):
+        for chunk in (512, 1024, 1 << 20):
+            for dwn in (1, 2, 3):
+                for cutoff in (None, 120):
+                    res = self.parse(jit, chunk=chunk, downsample=dwn,
+                                     cutoff_at_channel=cutoff)
+                    self.assertEqual(res.dtype, self.depth)
+                    np.testing.assert_array_equal(
+                        res, expected(self.truth, self.depth, dwn, cutoff))
+
+    def test_python_loop(self):
+        self.check_backend(jit=False)
+
+    @unittest.skipUnless(bcf_hype.jit_unbcf, 'numba is not present')
+    def test_jit_kernel(self):
+        self.check_backend(jit=True)
+
+    def test_stripes(self):
+        for jit in self.backends():
+            for dwn in (1, 2):
+                full = self.parse(jit, downsample=dwn)
+                for rows in (1, 2, 4):
+                    stripes = [self.parse(jit, downsample=dwn,
+                                          y_start=y, y_stop=y + rows)
+                               for y in range(0, full.shape[0], rows)]
+                    np.testing.assert_array_equal(
+                        np.concatenate(stripes), full)
+
+    def test_located_stripes(self):
+        for jit in self.backends():
+            for chunk in (512, 1 << 20):
+                for dwn in (1, 2):
+                    full = self.parse(jit, downsample=dwn)
+                    y_starts = range(0, full.shape[0], 2)
+                    starts = self.reader(jit, chunk)._locate_lines(
+                        0, [y * dwn for y in y_starts])
+                    for y, start in zip(y_starts, starts):
+                        stripe = self.parse(jit, chunk=chunk, downsample=dwn,
+                                            y_start=y, y_stop=y + 2,
+                                            start=start)
+                        np.testing.assert_array_equal(stripe, full[y:y + 2])
+
+    def test_lazy(self):
+        for jit in self.backends():
+            for dwn in (1, 2):
+                full = self.parse(jit, downsample=dwn)
+                for rows in (1, 3, 'auto'):
+                    res = self.reader(jit).parse_hypermap(
+                        index=0, downsample=dwn, lazy=True, chunks=rows)
+                    np.testing.assert_array_equal(res.compute(), full)
+
+    def test_workers(self):
+        for jit in self.backends():
+            for dwn in (1, 2):
+                full = self.parse(jit, downsample=dwn)
+                for n_workers in (2, 4, 16):
+                    res = self.reader(jit).parse_hypermap(
+                        index=0, downsample=dwn, n_workers=n_workers)
+                    np.testing.assert_array_equal(res, full)
+
+    def test_out(self):
+        out = np.zeros((4, 9, self.chan), dtype=self.depth)
+        res = self.parse(False, y_start=2, y_stop=6, out=out)
+        self.assertIs(res, out)
+        np.testing.assert_array_equal(out, self.parse(False)[2:6])
+        with self.assertRaises(ValueError):
+            self.parse(False, y_start=2, y_stop=6, out=out[:, ::2])
+
+
+class TestPyParseHypermapLargeGain(TestPyParseHypermap):
+
+    """instructed runs with gains above the hypermap depth (uint8)
+    must wrap around, not raise"""
+
+    depth = np.uint8
+
+    def setUp(self):
+        self.data, self.truth = build_spectrum_data(11, 9, self.chan,
+                                                    seed=1, flags=(2,),
+                                                    max_count=3000)
+        self.jit = bcf_hype.jit_unbcf
+
+
+class TestPyParseHypermapShortPixels(TestPyParseHypermap):
+
+    """pulses and instructed channels at and above the chan1 of
+    the pixel are dropped by both backends"""
+
+    def setUp(self):
+        self.data, self.truth = build_spectrum_data(11, 9, self.chan,
+                                                    seed=2, short=True)
+        self.jit = bcf_hype.jit_unbcf
+
+
+class TestCorruptedPixels(unittest.TestCase):
+
+    """corrupted pixel records raise instead of writing out of the map"""
+
+    def stream(self, x_pix, flag, payload, n_of_pulses=0):
+        data = bytearray(struct.pack('<ii', 2, 3))
+        data += bytes(0x1A0 - len(data))
+        for y in range(2):
+            data += struct.pack('<i', 1)
+            data += struct.pack('<IHHIHHHI', x_pix, 50, 50, 0, flag,
+                                len(payload), n_of_pulses, len(payload))
+            data += payload
+        return bytes(data)
+
+    def parse(self, data, jit):
+        jit_unbcf = bcf_hype.jit_unbcf
+        bcf_hype.jit_unbcf = jit
+        try:
+            return make_reader(data, 50, np.uint16).py_parse_hypermap(
+                index=0)
+        finally:
+            bcf_hype.jit_unbcf = jit_unbcf
+
+    def test_x_outside_map(self):
+        data = self.stream(3, 0, struct.pack('<4H', 1, 2, 3, 4))
+        for jit in [False, True] if bcf_hype.jit_unbcf else [False]:
+            with self.assertRaises(ValueError):
+                self.parse(data, jit)
+
+    @unittest.skipUnless(bcf_hype.jit_unbcf, 'numba is not present')
+    def test_instructions_overrun(self):
+        # run of 200 uint32 values in 8 bytes of pixel data:
+        data = self.stream(0, 2, struct.pack('<BBIH', 8, 200, 1, 0))
+        with self.assertRaises(ValueError):
+            self.parse(data, True)
+        # 12-bit pulses past the pixel data of the last pixel:
+        data = self.stream(0, 1, bytes(6), n_of_pulses=8)
+        with self.assertRaises(ValueError):
+            self.parse(data, True)
+
+
+def _aacs(content, blk_size):
+    """zlib compress content the way SFS does (AACS header and blocks)"""
+    blocks = [content[i:i + blk_size]
+              for i in range(0, len(content), blk_size)]
+    out = bytearray(struct.pack('<IIII', 0x53434141, blk_size, 0,
+                                len(blocks)))
+    out += bytes(0x80 - len(out))
+    for block in blocks:
+        packed = zlib.compress(block)
+        out += struct.pack('<IIII', len(packed), len(block), 0,
+                           len(packed) + 0x10)
+        out += packed
+    return bytes(out)
+
+
+def build_sfs(path, files, chunksize=0x800, compress=False, blk_size=0x3000,
+              seed=0):
+    """write SFS container with files (dict of internal path: content)
+    to path. Data and pointer table chunks are placed in random order,
+    items are listed before their directories."""
+    usable = chunksize - 32
+    dirs = sorted({f.rsplit('/', 1)[0] for f in files if '/' in f})
+    names = list(files) + dirs
+    streams = [_aacs(files[n], blk_size) if compress else files[n]
+               for n in files]
+    n_data = [-(-len(st) // usable) for st in streams]
+    n_table = [-(-n // (usable // 4)) for n in n_data]
+    n_chunks = 2 + sum(n_data) + sum(n_table)  # + header and tree chunks
+    free = list(range(2, n_chunks))
+    random.Random(seed).shuffle(free)
+    sfs = bytearray(chunksize * n_chunks + 0x118)
+    sfs[:8] = b'AAMVHFSS'
+    struct.pack_into('<fI', sfs, 0x124, 2.6, chunksize)
+    struct.pack_into('<III', sfs, 0x140, 1, len(names), n_chunks)
+    tree = np.zeros(len(names), dtype=bcf_hype.TREE_DTYPE)
+    for i, name in enumerate(names):
+        parent, dummy1, base = name.rpartition('/')
+        tree['name'][i] = base.encode()
+        tree['parent'][i] = names.index(parent) if parent else -1
+        tree['is_dir'][i] = name in dirs
+    for i, stream in enumerate(streams):
+        data = [free.pop() for dummy1 in range(n_data[i])]
+        table = [free.pop() for dummy1 in range(n_table[i])]
+        tree['ptr_to_ptr_table'][i] = table[0]
+        tree['size'][i] = len(stream)
+        ptrs = np.array(data, dtype='<u4').tobytes()
+        for k, chunk in enumerate(table):
+            if k + 1 < len(table):
+                struct.pack_into('<I', sfs, chunksize * chunk + 0x118,
+                                 table[k + 1])
+            part = ptrs[k * usable:(k + 1) * usable]
+            start = chunksize * chunk + 0x138
+            sfs[start:start + len(part)] = part
+        for k, chunk in enumerate(data):
+            part = stream[k * usable:(k + 1) * usable]
+            start = chunksize * chunk + 0x138
+            sfs[start:start + len(part)] = part
+    raw_tree = tree.tobytes()
+    sfs[chunksize + 0x138:chunksize + 0x138 + len(raw_tree)] = raw_tree
+    with open(path, 'wb') as fn:
+        fn.write(sfs)
+
+
+class TestSFSReader(unittest.TestCase):
+
+    chunksize = 0x800
+
+    def setUp(self):
+        rnd = random.Random(3)
+        usable = self.chunksize - 32
+        # big file needs pointer table in 3 chunks:
+        self.files = {
+            'dir/big.bin': bytes(rnd.getrandbits(8)
+                                 for _ in range(usable * 1100 + 77)),
+            'small.bin': bytes(range(256)) * 3}
+        self.tmp = tempfile.TemporaryDirectory()
+        self.paths = {}
+        self.readers = {}
+        for compress in (False, True):
+            path = os.path.join(self.tmp.name, 'c{0}.sfs'.format(compress))
+            build_sfs(path, self.files, chunksize=self.chunksize,
+                      compress=compress)
+            self.paths[compress] = path
+            self.readers[compress] = bcf_hype.SFS_reader(path)
+
+    def tearDown(self):
+        for reader in self.readers.values():
+            reader.close()
+        bcf_hype.SFS_reader._open_cache.clear()
+        self.tmp.cleanup()
+
+    def test_tree(self):
+        for compress, reader in self.readers.items():
+            self.assertEqual(reader.compression,
+                             'zlib' if compress else 'None')
+            self.assertEqual(sorted(reader.vfs), ['dir', 'small.bin'])
+            self.assertEqual(list(reader.vfs['dir']), ['big.bin'])
+            item = reader.get_file('dir/big.bin')
+            self.assertEqual(item.name, 'big.bin')
+            self.assertEqual(len(item.pointers), item.size_in_chunks)
+
+    def test_read_whole(self):
+        for reader in self.readers.values():
+            for name, content in self.files.items():
+                item = reader.get_file(name)
+                self.assertEqual(item.get_as_BytesIO_string().getvalue(),
+                                 content)
+                for views in (False, True):
+                    chunks = item.get_iter_and_properties(views=views)[0]
+                    self.assertEqual(b''.join(chunks), content)
+
+    def test_first_chunk(self):
+        for reader in self.readers.values():
+            item = reader.get_file('dir/big.bin')
+            last = item.get_iter_and_properties()[2] - 1
+            for first in (1, 7, last // 2 + 1, last):
+                iter_data, size_chnk, n_chunks = \
+                    item.get_iter_and_properties(first=first)
+                chunks = list(iter_data)
+                self.assertEqual(len(chunks), n_chunks)
+                self.assertEqual(b''.join(chunks),
+                                 self.files['dir/big.bin'][first * size_chnk:])
+
+    def test_read_piece(self):
+        item = self.readers[False].get_file('dir/big.bin')
+        content = self.files['dir/big.bin']
+        usable = self.chunksize - 32
+        # within, across one and many chunk boundaries, across
+        # the boundary of pointer table chunks, till the end:
+        for offset, length in ((0, 10), (5, usable - 5), (usable - 5, 10),
+                               (3 * usable - 1, 2 * usable + 2),
+                               (usable * usable // 4 - 3, 6),
+                               (len(content) - usable - 10, usable + 10)):
+            piece = item.read_piece(offset, length)
+            self.assertIs(type(piece), bytes)
+            self.assertEqual(piece, content[offset:offset + length])
+
+    def test_close_with_views(self):
+        reader = self.readers[False]
+        chunks = reader.get_file('small.bin').get_iter_and_properties(
+            views=True)[0]
+        view = next(chunks)
+        reader.close()
+        self.assertTrue(reader.closed)
+        del view, chunks
+
+    def test_pickle(self):
+        for reader in self.readers.values():
+            clone = pickle.loads(pickle.dumps(reader))
+            reader.close()
+            for name, content in self.files.items():
+                self.assertEqual(clone.get_file(
+                    name).get_as_BytesIO_string().getvalue(), content)
+            clone.close()
+            # closed reader stays closed:
+            clone = pickle.loads(pickle.dumps(reader))
+            self.assertTrue(clone.closed)
+            clone.close()
+
+    def test_open(self):
+        path = self.paths[True]
+        reader = bcf_hype.SFS_reader.open(path)
+        self.assertIs(bcf_hype.SFS_reader.open(path), reader)
+        reader.close()
+        reopened = bcf_hype.SFS_reader.open(path)
+        self.assertIsNot(reopened, reader)
+        self.assertEqual(reopened.get_file(
+            'small.bin').get_as_BytesIO_string().getvalue(),
+            self.files['small.bin'])
+        reopened.close()
+
+
+def _b64_u16(array):
+    return base64.b64encode(np.asarray(array, '<u2').tobytes()).decode()
+
+
+def _image_xml(image, description, name=None, overlay=''):
+    """TRTImageData node with image plane and an empty plane"""
+    height, width = image.shape
+    return ('<ClassInstance Type="TRTImageData"{0}>'
+            '<Width>{1}</Width><Height>{2}</Height><PlaneCount>2</PlaneCount>'
+            '<Plane0><Data>{3}</Data><Description>{4}</Description></Plane0>'
+            '<Plane1><Data>{5}</Data><Description>empty</Description>'
+            '</Plane1>{6}</ClassInstance>').format(
+                ' Name="{0}"'.format(name) if name else '', width, height,
+                _b64_u16(image), description, _b64_u16(np.zeros_like(image)),
+                overlay)
+
+
+def build_header(height, width, sum_eds, image, overview):
+    """HeaderData xml of bcf (v2) with one hypermap"""
+    det_layers = base64.b64encode(zlib.compress(
+        b'<DetLayers><Layer0 Atom="5" Thickness="0.02"/></DetLayers>'))
+    overlay = ('<ChildClassInstances>'
+               '<ClassInstance Type="TRTRectangleOverlayElement" Name="Map">'
+               '<TRTSolidOverlayElement><TRTBasicLineOverlayElement>'
+               '<TRTOverlayElement><Rect><Top>1</Top><Left>2</Left>'
+               '<Bottom>3</Bottom><Right>4</Right></Rect></TRTOverlayElement>'
+               '</TRTBasicLineOverlayElement></TRTSolidOverlayElement>'
+               '</ClassInstance></ChildClassInstances>')
+    return (
+        '<TRTSpectrumDatabase>'
+        '<ClassInstance Type="TRTSpectrumDatabase" Name="sample 1">'
+        '<Header><Date>01.02.2016</Date><Time>10:20:30</Time>'
+        '<FileVersion>2</FileVersion></Header>'
+        '<ClassInstance Type="TRTSEMData"><HV>15</HV><DX>0.5</DX>'
+        '<DY>0.25</DY><Mag>1000</Mag></ClassInstance>'
+        '<ClassInstance Type="TRTSEMStageData"><X>1.5</X><Y>-2</Y>'
+        '</ClassInstance>'
+        '<ClassInstance Type="TRTDSPConfiguration"><LineAverage>1'
+        '</LineAverage><PixelAverage>2</PixelAverage><PixelTime>100'
+        '</PixelTime></ClassInstance>' +
+        _image_xml(image, 'BSE') +
+        '<ClassInstance Type="TRTContainerClass"><ChildClassInstances>'
+        '<ClassInstance Type="TRTContainerClass" Name="OverviewImages">'
+        '<ChildClassInstances>' +
+        _image_xml(overview, 'SE', name='Overview', overlay=overlay) +
+        '</ChildClassInstances></ClassInstance>'
+        '<ClassInstance Type="TRTElementInformationList">'
+        '<ClassInstance Type="TRTSpectrumRegionList"><ChildClassInstances>'
+        '<ClassInstance Type="TRTSpectrumRegion" Name="Si"><Line>K</Line>'
+        '<Energy>1.74</Energy><Width>0.1</Width></ClassInstance>'
+        '<ClassInstance Type="TRTSpectrumRegion" Name="Fe"><Line>KA</Line>'
+        '<Energy>6.4</Energy><Width>0.15</Width></ClassInstance>'
+        '</ChildClassInstances></ClassInstance></ClassInstance>'
+        '</ChildClassInstances></ClassInstance>'
+        '<LineCounter>{0},{0}</LineCounter><ChCount>{1}</ChCount>'
+        '<DetectorCount>1</DetectorCount>'
+        '<SpectrumData0><ClassInstance Type="TRTSpectrum" Name="sum">'
+        '<TRTHeaderedClass>'
+        '<ClassInstance Type="TRTSpectrumHardwareHeader">'
+        '<Amplification>20000</Amplification></ClassInstance>'
+        '<ClassInstance Type="TRTDetectorHeader"><Type>XFlash</Type>'
+        '<DetLayers>{2}</DetLayers></ClassInstance>'
+        '<ClassInstance Type="TRTESMAHeader"><PrimaryEnergy>15'
+        '</PrimaryEnergy><ElevationAngle>35</ElevationAngle>'
+        '<AzimutAngle>90</AzimutAngle></ClassInstance>'
+        '</TRTHeaderedClass>'
+        '<ClassInstance Type="TRTSpectrumHeader"><CalibAbs>-0.5</CalibAbs>'
+        '<CalibLin>0.05</CalibLin><ChannelCount>{1}</ChannelCount>'
+        '</ClassInstance>'
+        '<Channels>{3}</Channels>'
+        '</ClassInstance></SpectrumData0>'
+        '</ClassInstance></TRTSpectrumDatabase>').format(
+            height, len(sum_eds), det_layers.decode(),
+            ','.join(str(v) for v in sum_eds)).encode()
+
+
+class TestFileReader(unittest.TestCase):
+
+    """file_reader on synthetic bcf: SFS container with HeaderData and
+    SpectrumData0 (15 kV, 0.05 keV/channel from -0.5 keV: 310 channels)"""
+
+    height, width, chan = 7, 6, 310
+
+    def setUp(self):
+        rnd = np.random.RandomState(4)
+        self.data, self.truth = build_spectrum_data(
+            self.height, self.width, self.chan, seed=5, max_count=300)
+        sum_eds = np.zeros(400, dtype=np.int64)
+        sum_eds[:self.chan] = self.truth.sum(axis=(0, 1))
+        # zero peak making the hypermap depth uint16:
+        sum_eds[0] = 2000 * self.height * self.width
+        self.image = rnd.randint(1, 60000, (self.height, self.width))
+        self.overview = rnd.randint(1, 60000, (3, 4))
+        header = build_header(self.height, self.width, sum_eds, self.image,
+                              self.overview)
+        self.tmp = tempfile.TemporaryDirectory()
+        self.paths = []
+        for compress in (False, True):
+            path = os.path.join(self.tmp.name, 'map{0}.bcf'.format(compress))
+            build_sfs(path, {'EDSDatabase/HeaderData': header,
+                             'EDSDatabase/SpectrumData0': self.data},
+                      compress=compress)
+            self.paths.append(path)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def check_hypermap(self, item, downsample=1, cutoff=None):
+        data = item['data']
+        if hasattr(data, 'compute'):
+            data = data.compute()
+        self.assertEqual(data.dtype, np.uint16)
+        np.testing.assert_array_equal(
+            data, expected(self.truth, np.uint16, downsample, cutoff))
+        scales = [0.25 * downsample, 0.5 * downsample, 0.05]
+        for axis, size, scale in zip(item['axes'], data.shape, scales):
+            self.assertEqual(axis['size'], size)
+            self.assertAlmostEqual(axis['scale'], scale)
+        self.assertEqual(item['axes'][2]['offset'], -0.5)
+
+    def test_images(self):
+        for path in self.paths:
+            image, overview = bcf_hype.file_reader(path, select_type='image')
+            np.testing.assert_array_equal(image['data'], self.image)
+            np.testing.assert_array_equal(overview['data'], self.overview)
+            image['data'] += 1  # writable
+            self.assertEqual(image['metadata']['General'],
+                             {'title': 'BSE',
+                              'original_filename': os.path.basename(path)})
+            self.assertEqual(image['metadata']['Acquisition_instrument'],
+                             {'SEM': {'beam_energy': 15,
+                                      'magnification': 1000}})
+            self.assertEqual([a['scale'] for a in image['axes']], [0.25, 0.5])
+            self.assertEqual(
+                overview['metadata']['Markers']['overview']['data'],
+                {'y1': 0.25, 'x1': 1.0, 'y2': 0.75, 'x2': 2.0})
+
+    def test_hypermap_metadata(self):
+        items = bcf_hype.file_reader(self.paths[0])
+        self.assertEqual(len(items), 3)
+        hmap = items[2]
+        self.check_hypermap(hmap)
+        meta = hmap['metadata']
+        self.assertEqual(meta['General'],
+                         {'original_filename': 'mapFalse.bcf', 'title': 'EDX',
+                          'date': '2016-02-01', 'time': '10:20:30'})
+        self.assertEqual(meta['Sample'],
+                         {'name': 'sample 1', 'elements': ['Fe', 'Si'],
+                          'xray_lines': ['Fe_Ka', 'Si_Ka']})
+        self.assertEqual(meta['Signal']['signal_type'], 'EDS_SEM')
+        real_time = 2 * self.height * 1 * 2 * 100 * self.width / 1e6
+        self.assertEqual(meta['Acquisition_instrument'], {'SEM': {
+            'beam_energy': 15, 'magnification': 1000,
+            'Detector': {'EDS': {'elevation_angle': 35,
+                                 'detector_type': 'XFlash',
+                                 'real_time': real_time,
+                                 'azimuth_angle': 90}}}})
+        orig = hmap['original_metadata']
+        self.assertEqual(orig['Detector']['DetLayers'],
+                         {'Layer0': {'Atom': '5', 'Thickness': '0.02'}})
+        self.assertEqual(orig['Stage'],
+                         {'XmlClassType': 'TRTSEMStageData', 'X': 1.5,
+                          'Y': -2})
+        self.assertEqual(orig['Line counter'], (self.height, self.height))
+        self.assertEqual(orig['Spectrum']['ChannelCount'], 400)
+
+    def test_header(self):
+        with bcf_hype.BCF_reader(self.paths[1]) as reader:
+            eds = reader.header.get_spectra_metadata(0)
+            np.testing.assert_allclose(eds.energy,
+                                       -0.5 + 0.05 * np.arange(400))
+            self.assertEqual(eds.energy_to_channel(10), 210)
+            self.assertEqual(reader.header.estimate_map_channels(), 310)
+            self.assertEqual(reader.header.estimate_map_depth(downsample=2),
+                             np.uint16)
+
+    def test_lazy(self):
+        close = bcf_hype.SFS_reader.close
+        for path in self.paths:
+            for lazy in (False, True):
+                with mock.patch.object(bcf_hype.SFS_reader, 'close',
+                                       autospec=True,
+                                       side_effect=close) as closed:
+                    hmap = bcf_hype.file_reader(path, select_type='spectrum',
+                                                lazy=lazy)[0]
+                # lazy hypermap reads the file on compute:
+                self.assertEqual(closed.called, not lazy)
+                self.assertEqual(hasattr(hmap['data'], 'compute'), lazy)
+                self.check_hypermap(hmap)
+
+    def test_processes_scheduler(self):
+        hmap = bcf_hype.file_reader(self.paths[1], select_type='spectrum',
+                                    lazy=True)[0]
+        np.testing.assert_array_equal(
+            hmap['data'].compute(scheduler='processes'),
+            expected(self.truth, np.uint16))
+
+    def test_downsample_cutoff(self):
+        for path in self.paths:
+            for lazy in (False, True):
+                hmap = bcf_hype.file_reader(path, select_type='spectrum',
+                                            downsample=2, cutoff_at_kV=10,
+                                            lazy=lazy)[0]
+                self.check_hypermap(hmap, downsample=2, cutoff=210)
+
+
+class TestXmlHelpers(unittest.TestCase):
+
+    def test_interpret(self):
+        for value in (0, -12, 4096, 3.5, -0.25, 0.001, 1e+20, [1, 2.5],
+                      (1, 'a'), {'k': 1}, True, False, None, 'abc',
+                      '1.2.2016', 'Si Ka', ''):
+            self.assertEqual(bcf_hype.interpret(str(value)), value)
+        self.assertEqual(bcf_hype.interpret(7), 7)
+
+    def test_dictionarize(self):
+        values = {'ChannelCount': 4096, 'CalibLin': 0.01, 'Date': '1.2.2016',
+                  'Range': [0, 20.5], 'Name': 'spectrum', 'Flag': True}
+        xml = ''.join('<{0}>{1}</{0}>'.format(k, v) for k, v in values.items())
+        root = ET.fromstring(
+            '<TRTHeaderedClass>'
+            '<ClassInstance Type="TRTSpectrumHeader" Name="Spec">' + xml +
+            '<Empty/><Rep>1</Rep><Rep>b</Rep><Rep>3</Rep>'
+            '<Node Unit="keV"> 20.5 </Node>'
+            '<Deep><Deeper><Deepest>-1</Deepest></Deeper></Deep>'
+            '</ClassInstance></TRTHeaderedClass>')
+        expected = dict(values, XmlClassType='TRTSpectrumHeader',
+                        XmlClassName='Spec', Empty=None, Rep=[1, 'b', 3],
+                        Node={'Unit': 'keV', '#text': 20.5},
+                        Deep={'Deeper': {'Deepest': -1}})
+        self.assertEqual(bcf_hype.dictionarize(root),
+                         {'TRTHeaderedClass': expected})
+        self.assertEqual(bcf_hype.dictionarize(root[0]), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()